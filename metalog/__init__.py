@@ -1 +1,6 @@
-from .elab import Manager, Experiment
+# Imported on first access, so that the command line interface starts fast
+def __getattr__(name):
+    if name in ("Manager", "Experiment"):
+        from . import elab
+        return getattr(elab, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,173 @@
+"""Headless command line interface for batch logging.
+
+Jobs are dictionaries whose "action" is one of "journal", "sample",
+"instrument" or "upload"; the other keys are the same fields of the
+Streamlit app (e.g. "System", "Project", "sample_name"). Jobs are read
+from YAML/JSON job files or, one JSON object per line, from stdin.
+All the jobs of an invocation share the same state (so a "sample" job
+is logged in the journal created by a previous "journal" job) and the
+same connection to elabFTW.
+
+Heavy dependencies are imported only when needed, so that a one-shot
+command starts fast.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+# Fields linking an entry to database items, they require the database
+LINK_CATEGORIES = ("Project", "TopicProposal", "Researcher", "Substrate")
+
+ACTIONS = ("journal", "sample", "instrument", "upload")
+
+class State(dict):
+    """Session state of a headless run, mimics streamlit.session_state
+
+    Missing fields read as None.
+    """
+
+    def __missing__(self, key):
+        return None
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return self.get(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+def read_jobs(path):
+    """ Read jobs from a job file, "-" reads JSON lines from stdin
+
+    Errors do not stop the reading: a job which cannot be read (e.g. a
+    malformed stdin line, a missing or malformed job file) is yielded as
+    the exception raised while reading it.
+
+    Args:
+        path: path to a YAML or JSON job file, or "-"
+
+    Return: iterator of job dictionaries or exceptions
+    """
+
+    if path == "-":
+        for line in sys.stdin:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    yield e
+        return
+
+    try:
+        with open(path) as f:
+            if path.endswith((".yaml", ".yml")):
+                try:
+                    import yaml
+                except ImportError:
+                    raise ImportError("pyyaml is required to read {}, install it with: pip install pyyaml".format(path))
+                jobs = yaml.safe_load(f)
+            else:
+                jobs = json.load(f)
+    except Exception as e:
+        yield e
+        return
+
+    if isinstance(jobs, dict):
+        jobs = jobs.get("jobs", [jobs])
+    if not isinstance(jobs, list):
+        yield ValueError("{} must contain a job or a list of jobs.".format(path))
+        return
+    for job in jobs:
+        yield job
+
+def run_job(state, job):
+    """ Run a single job on the given state
+
+    Args:
+        state: State shared among the jobs
+        job: dictionary with the "action" and the fields of the job
+
+    Return: nothing
+
+    Raise: tools.LogError if the job is rejected by the validation
+    """
+
+    from . import tools
+
+    if not isinstance(job, dict):
+        raise ValueError("A job must be a dictionary, not {!r}.".format(job))
+    job = dict(job)
+    action = job.pop("action", None)
+    if action not in ACTIONS:
+        raise ValueError("Unknown action {!r}, use one of {}.".format(action, ", ".join(ACTIONS)))
+
+    # Fields given by a job last only for that job, except the experiments
+    for key in LINK_CATEGORIES + ("upload_expid", "upload_files", "upload_images"):
+        state.pop(key, None)
+    state.update(job)
+
+    if "journal_id" in job:
+        state.journal_exp = state.manager.get_experiment(int(job["journal_id"]))
+        state.journal_exp.set_rollover(max_cells=tools.JOURNAL_MAX_CELLS, max_body_size=tools.JOURNAL_MAX_BODY_SIZE)
+    if state.database is None and any(state.get(cat) for cat in LINK_CATEGORIES):
+        state.database = tools.get_database(state)
+    if action == "sample" and state.System and not state.prev_prep and "sample_name" not in job:
+        tools.system_changed(state)
+
+    if action == "journal":
+        tools.journal_log(state)
+    elif action == "sample":
+        tools.sample_log(state)
+    elif action == "instrument":
+        # Not implemented in tools.instrument_log yet, do not report success
+        raise NotImplementedError("Instrument logging is not available yet.")
+    elif action == "upload":
+        tools.upload_log(state)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="metalog",
+        description="Headless batch logging to elabFTW.")
+    parser.add_argument(
+        "jobs",
+        nargs="*",
+        default=["-"],
+        help='YAML/JSON job files, "-" (default) reads one JSON job per line from stdin')
+    parser.add_argument(
+        "--endpoint",
+        default=os.environ.get("METALOG_ENDPOINT"),
+        help="elabFTW API endpoint (default: $METALOG_ENDPOINT)")
+    parser.add_argument(
+        "--token",
+        default=os.environ.get("METALOG_TOKEN"),
+        help="elabFTW API token (default: $METALOG_TOKEN)")
+    args = parser.parse_args(argv)
+
+    if not args.endpoint or not args.token:
+        parser.error("endpoint and token are required (--endpoint/--token or $METALOG_ENDPOINT/$METALOG_TOKEN)")
+
+    from . import elab, tools
+
+    state = State(prev_prep=False, sample_preparation="")
+    state.manager = elab.Manager(endpoint=args.endpoint, token=args.token)
+    tools.set_date(state)
+
+    errors = 0
+    for path in args.jobs:
+        for n, job in enumerate(read_jobs(path), 1):
+            try:
+                if isinstance(job, Exception):
+                    raise job
+                run_job(state, job)
+            except Exception as e:
+                errors += 1
+                print("Error in job {} of {}: {}".format(n, path, e), file=sys.stderr)
+
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,253 @@
+import copy
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+try:
+    from .throttle import Controller
+except ImportError:
+    from throttle import Controller
+
+class Client():
+
+    def __init__(self, instance, ttl=5.0, controller=None, max_entries=256):
+        """Middleware wrapping an elabapy Manager
+
+        Every call made through the Client is forwarded to the wrapped
+        elabapy Manager. Read calls ("get_*") are deduplicated: identical
+        concurrent calls share a single request (single-flight) and
+        responses are cached for "ttl" seconds (at most "max_entries"
+        responses, least recently used first out). Any other call is treated
+        as a write and invalidates the cached responses of the resource it
+        touches (e.g. "post_experiment(12, ...)" drops "get_experiment(12)"
+        and every experiment listing). The requests actually sent to the
+        server go through an adaptive concurrency Controller.
+
+        Args:
+            instance: elabapy.Manager to be wrapped
+            ttl: (float, optional) coherence window of cached GET responses in seconds
+            controller: (throttle.Controller, optional) concurrency controller of the requests. If not given a default one is created.
+            max_entries: (integer, optional) maximum number of cached GET responses
+
+        Return: None
+        """
+
+        self.instance = instance
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.controller = controller if controller is not None else Controller()
+
+        # Callables notified as listener(name, args, result) after each successful write
+        self.listeners = list()
+
+        # Requests actually sent to the server (retries included) and calls served by the cache
+        self.requests = Counter()
+        self.hits = Counter()
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._local = threading.local()
+        self._inflight = dict()
+        self._generation = Counter()
+
+    def __repr__(self):
+        return "Client wrapping {}.".format(self.instance)
+
+    def __getattr__(self, name):
+        attr = getattr(self.instance, name)
+        if not callable(attr):
+            return attr
+        if name.startswith("get_"):
+            def method(*args, **kwargs):
+                return self._read(name, attr, args, kwargs)
+        else:
+            def method(*args, **kwargs):
+                return self._write(name, attr, args, kwargs)
+        return method
+
+    def get_request_counts(self):
+        """ Get per-operation request counters
+
+        Return:
+            Dictionary with keys "requests" (requests sent to the server, retries included) and
+            "hits" (calls answered from the cache or coalesced), each
+            mapping operation names to counts.
+        """
+
+        with self._lock:
+            return {"requests": dict(self.requests),
+                    "hits": dict(self.hits)}
+
+    @contextmanager
+    def uncached(self):
+        """ Context manager for reads of the current thread bypassing the cache
+
+        Reads within the context are neither served from nor stored in the
+        cache, e.g. to fetch many experiments once without keeping them.
+        """
+
+        previous = getattr(self._local, "uncached", False)
+        self._local.uncached = True
+        try:
+            yield self
+        finally:
+            self._local.uncached = previous
+
+    def invalidate(self, resource=None, resid=None):
+        """ Drop cached responses
+
+        Args:
+            resource: (string, optional) resource name (e.g. "experiments"). If not given the whole cache is dropped.
+            resid: (integer, optional) id of the resource. If not given all the entries of the resource are dropped.
+
+        Return: nothing
+        """
+
+        with self._lock:
+            self._invalidate(resource, resid)
+
+    def _invalidate(self, resource, resid):
+        # Must be called with self._lock held
+        if resource is None:
+            self._cache.clear()
+            self._inflight.clear()
+            for res in list(self._generation):
+                self._generation[res] += 1
+            return
+        self._generation[resource] += 1
+        for entries in (self._cache, self._inflight):
+            for key in list(entries):
+                res, kid = key[0]
+                if res == resource and (resid is None or kid is None or kid == resid):
+                    del entries[key]
+
+    def _read(self, name, func, args, kwargs):
+        key = (_resource(name, args), name, repr(args), repr(sorted(kwargs.items())))
+        resource = key[0][0]
+        uncached = getattr(self._local, "uncached", False)
+
+        with self._lock:
+            entry = None if uncached else self._cache.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self.hits[name] += 1
+                self._cache.move_to_end(key)
+                return copy.deepcopy(entry[1])
+            call = self._inflight.get(key)
+            if call is not None:
+                self.hits[name] += 1
+                leader = False
+            else:
+                call = _Call()
+                self._inflight[key] = call
+                generation = self._generation[resource]
+                leader = True
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = self.controller.call(resource, func, *args, operation=name,
+                                               attempted=lambda: self._count(name), **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is call:
+                    del self._inflight[key]
+                # Do not cache responses which may predate a write
+                if call.error is None and self._generation[resource] == generation and not uncached:
+                    self._store(key, call.result)
+            call.event.set()
+
+        return copy.deepcopy(call.result)
+
+    def _count(self, name):
+        with self._lock:
+            self.requests[name] += 1
+
+    def _store(self, key, result):
+        # Must be called with self._lock held
+        now = time.monotonic()
+        for k in [k for k, entry in self._cache.items() if now - entry[0] >= self.ttl]:
+            del self._cache[k]
+        self._cache.pop(key, None)
+        self._cache[key] = (now, result)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def _write(self, name, func, args, kwargs):
+        resource, resid = _resource(name, args)
+
+        try:
+            result = self.controller.call(resource, func, *args, operation=name, write=True,
+                                          rewind=_rewinder(args, kwargs),
+                                          attempted=lambda: self._count(name), **kwargs)
+        finally:
+            self.invalidate(resource, resid)
+
+        for listener in self.listeners:
+            listener(name, args, result)
+
+        return result
+
+def _rewinder(args, kwargs):
+    """ Return a callable rewinding the files passed to a write, for retries
+
+    Files are passed by elabapy in the params dictionary (e.g. {'file': f}).
+    Return None if there are no files and False if they cannot be rewound,
+    in which case the write must not be retried.
+    """
+
+    files = list()
+    for value in list(args) + list(kwargs.values()):
+        values = value.values() if isinstance(value, dict) else [value]
+        for f in values:
+            if hasattr(f, "read"):
+                if not (hasattr(f, "seekable") and f.seekable()):
+                    return False
+                files.append((f, f.tell()))
+
+    if not files:
+        return None
+
+    def rewind():
+        for f, position in files:
+            f.seek(position)
+
+    return rewind
+
+class _Call():
+    """ Pending GET shared by coalesced callers """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+def _resource(name, args):
+    """ Map an elabapy method call to the (resource, id) it touches
+
+    """
+
+    if "items_type" in name:
+        resource = "items_types"
+    elif "experiment" in name:
+        resource = "experiments"
+    elif "item" in name:
+        resource = "items"
+    else:
+        resource = name.split("_")[-1].rstrip("s") + "s"
+
+    resid = None
+    if args and not name.startswith(("get_all_", "create_")):
+        try:
+            resid = int(args[0])
+        except (TypeError, ValueError):
+            resid = None
+
+    return (resource, resid)
@@ -1,24 +1,55 @@
 import os
-import json, re
+import json, re, html, ast
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import urljoin
 from dateutil.tz import tzlocal
 import elabapy
+import requests
+import urllib3
+
+try:
+    from .client import Client
+    from .throttle import Controller
+    from .search import SearchIndex
+    from .export import COLUMNS, get_writer
+    from .links import LinkGraph
+except ImportError:
+    # Running as a script (e.g. "streamlit run metalog/main.py")
+    from client import Client
+    from throttle import Controller
+    from search import SearchIndex
+    from export import COLUMNS, get_writer
+    from links import LinkGraph
 
 class Manager():
 
-    def __init__(self, endpoint, token):
+    def __init__(self, endpoint, token, cache_ttl=5.0, max_concurrency=16):
         """Class representing an elabFTW Manager
 
         Args:
             endpoint: endpoint to initialize the elabFTW Manager (e.g. "https://elab.example.org/api/v1")
             token: token to access the elabFTW Manager (e.g. "55cde...403157")
+            cache_ttl: (float, optional) seconds during which identical GET responses are reused (default 5.0)
+            max_concurrency: (integer, optional) maximum number of concurrent requests to elabFTW (default 16)
 
         Return: None
         """
 
-        # Initialize elabFTW Manager
+        # Initialize elabFTW Manager, all the traffic goes through the Client middleware
         self.endpoint = endpoint
-        self.instance = elabapy.Manager(endpoint=endpoint, token=token)
+        self.controller = Controller(max_limit=max_concurrency, max_total=max_concurrency)
+        self.instance = Client(_SessionManager(endpoint=endpoint, token=token, pool_size=max_concurrency),
+                               ttl=cache_ttl,
+                               controller=self.controller)
+
+        # Local search index, kept in sync with the writes made through the Client
+        self.index = SearchIndex(self.instance)
+        self.instance.listeners.append(self.index.notify)
+
+        # Local cache of the experiment<->item links, kept in sync with the link writes
+        self.links = LinkGraph(self.instance, self.index)
+        self.instance.listeners.append(self.links.notify)
 
     def __repr__(self):
         return "elabFTW Manager at {}.".format(self.endpoint)
@@ -63,6 +94,38 @@ class Manager():
 
         return all_exp
 
+    def search(self,
+               text=None,
+               tags=None,
+               category=None,
+               date_from=None,
+               date_to=None,
+               refresh=False):
+        """ Search experiments in the local search index
+
+        The index is built on first use and then kept in sync incrementally,
+        so queries do not download all the experiments.
+
+        Args:
+            text: (string, optional) words to be found in title, body or tags
+            tags: (list, optional) list of tags of the experiment
+            category: (string, optional) category of the experiment
+            date_from: (string, optional) earliest date of the experiment (e.g. "20210315")
+            date_to: (string, optional) latest date of the experiment (e.g. "20210315")
+            refresh: (boolean, optional) rebuild the index from a full listing before searching
+
+        Return:
+            List of dictionaries ("id", "title", "date", "category", "tags") sorted by date, newest first
+        """
+
+        self.index.sync(full=refresh)
+
+        return self.index.search(text=text,
+                                 tags=tags,
+                                 category=category,
+                                 date_from=date_from,
+                                 date_to=date_to)
+
     def get_experiment(self,
                        expid):
         """ Get experiment with given id
@@ -74,9 +137,43 @@ class Manager():
             Experiment instance
         """
 
-        exp = self.get_experiments(expid=expid)[0]
+        # Fetch the experiment directly instead of listing all of them
+        return Experiment(self.instance, expid=int(expid), graph=self.links)
 
-        return Experiment(self.instance, expid=int(exp['id']))
+    def get_experiment_links(self,
+                             expid):
+        """ Get the items linked to an experiment, from the local link graph
+
+        Args:
+            expid: (integer) id of the experiment
+
+        Return:
+            List of item ids
+        """
+
+        return sorted(self.links.get_links(expid))
+
+    def get_linked_experiments(self,
+                               item_id,
+                               category=None):
+        """ Get the experiments linked to an item, from the local link graph
+
+        The link graph is loaded in bulk on first use, e.g. to get all the
+        journals linked to a Project or Substrate without per-experiment GETs.
+
+        Args:
+            item_id: (integer) id of the item
+            category: (string, optional) category of the experiments
+
+        Return:
+            List of experiment ids
+        """
+
+        expids = self.links.get_experiments(item_id)
+        if category != None:
+            expids &= {exp["id"] for exp in self.search(category=category)}
+
+        return sorted(expids)
 
     def create_experiment(self,
                           title=None,
@@ -111,7 +208,8 @@ class Manager():
                           tags=tags,
                           links=links,
                           metadata=metadata,
-                          body=body)
+                          body=body,
+                          graph=self.links)
 
     def get_all_items(self, **kwargs):
         """ Get all items from database
@@ -153,6 +251,119 @@ class Manager():
 
         return self.instance.get_items_types()
 
+    def export(self,
+               path,
+               format=None,
+               expids=None,
+               meta_keys=None,
+               chunk_size=100,
+               workers=8,
+               **filters):
+        """ Export experiments and their metadata to a CSV, Parquet or Arrow file
+
+        Experiments are fetched in parallel (as bulk traffic) and written in
+        chunks of chunk_size rows, so memory use does not depend on the
+        number of exported experiments. Columns are "id", "title", "date",
+        "category", "tags", "links" (item ids), "metadata" and "cells"
+        (cell metadata as returned by Experiment._get_cells_meta), followed
+        by one "meta.<key>" column for each of meta_keys.
+
+        Args:
+            path: path of the output file
+            format: (string, optional) "csv", "parquet" or "arrow". If not given it is guessed from the file extension.
+            expids: (list, optional) ids of the experiments to export. If not given the experiments matching filters are exported.
+            meta_keys: (list, optional) metadata keys to be exported as separate columns. Nested keys are joined by "." (e.g. "sample.name").
+            chunk_size: (integer, optional) number of rows fetched and written at once
+            workers: (integer, optional) number of parallel fetches
+            **filters: filters of Manager.search (text, tags, category, date_from, date_to)
+
+        Return:
+            Number of exported experiments
+        """
+
+        if expids is None:
+            expids = [exp["id"] for exp in self.search(**filters)]
+        meta_keys = list(meta_keys or [])
+        columns = COLUMNS + ["meta." + key for key in meta_keys]
+
+        def fetch(expid):
+            # Bulk traffic, not kept in the cache to keep memory bounded
+            with self.bulk(), self.instance.uncached():
+                exp = self.instance.get_experiment(expid)
+            return _export_row(exp, meta_keys)
+
+        writer = get_writer(path, columns, format=format)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for i in range(0, len(expids), chunk_size):
+                    writer.write(list(executor.map(fetch, expids[i:i + chunk_size])))
+        finally:
+            writer.close()
+
+        return len(expids)
+
+    def get_request_counts(self):
+        """ Get per-operation counters of the requests sent to elabFTW
+
+        Return:
+            Dictionary with keys "requests" (sent to the server) and "hits" (served from cache or coalesced)
+        """
+
+        return self.instance.get_request_counts()
+
+    def bulk(self):
+        """ Context manager for bulk traffic (e.g. imports)
+
+        Requests issued by the current thread within the context leave a
+        slot free for interactive requests on each endpoint.
+
+        Example:
+            with manager.bulk():
+                for entry in entries:
+                    manager.create_experiment(**entry)
+        """
+
+        return self.controller.bulk()
+
+class _SessionManager(elabapy.Manager):
+    """ elabapy Manager sending all its requests through one requests.Session
+
+    elabapy opens a new connection for every request, sharing a Session
+    keeps the connections alive between requests (connection pool).
+    """
+
+    def __init__(self, *args, pool_size=16, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def send_req(self, url, params={}, verb='GET', binary=False, param_name='data'):
+        """ Send the request to the api endpoint, same as elabapy.baseapi.BaseAPI.send_req """
+
+        if self.verify == False:
+            urllib3.disable_warnings()
+
+        url = urljoin(self.endpoint, url)
+        headers = {'Authorization': self.token}
+        kwargs = {'headers': headers, param_name: params, 'verify': self.verify, 'proxies': self.proxies}
+
+        self._log.debug('{} {} {}'.format(verb, url, params))
+
+        req = self.session.request(verb, url, **kwargs)
+        if not req.ok:
+            req.raise_for_status()
+
+        # 204 No Content
+        if req.status_code == 204:
+            return True
+
+        if binary:
+            return req.content
+
+        return req.json()
+
 class Experiment():
 
     def __init__(self,
@@ -165,7 +376,8 @@ class Experiment():
                  tags=None,
                  links=None,
                  metadata=None,
-                 body=None):
+                 body=None,
+                 graph=None):
         """Class representing an elabFTW Experiment
 
         Args:
@@ -179,12 +391,26 @@ class Experiment():
             links: (list, optional) list of integers representing links to items
             metadata: (dictionary, optional) dictionaty of metadata to be attached to the experiment
             body: (string, optional) body text
+            graph: (links.LinkGraph, optional) link graph used to add only missing links
 
         Return: None
         """
 
         # Set elabFTW Manager
         self.manager = instance
+        self.graph = graph
+
+        # Journal rollover policy, see set_rollover()
+        self.max_cells = None
+        self.max_body_size = None
+        self._tail = None
+
+        # Cells of this Experiment, loaded from the body on first use and then
+        # kept up to date locally (number of cells, body size, next cell ID)
+        self._cells = None
+        self._entries = None
+        self._body_size = None
+        self._next_cell_id = None
 
         # Get Experiment ID
         if expid:
@@ -232,19 +458,39 @@ class Experiment():
             params = { "userid": userid }
             print(self.manager.post_experiment(self.expid, params))
         if tags != None:
-            for tag in tags:
-                params = { "tag": tag }
-                print(self.manager.post_experiment(self.expid, params))
+            for part in self._tagged_parts():
+                for tag in tags:
+                    params = { "tag": tag }
+                    print(self.manager.post_experiment(part.expid, params))
         if metadata != None:
-            params = { "metadata": json.dumps(metadata) }
+            params = { "metadata": json.dumps(self._keep_journal_meta(metadata)) }
             print(self.manager.post_experiment(self.expid, params))
         if body != None:
             params = { "body": body }
             print(self.manager.post_experiment(self.expid, params))
+            self._cells = None
         if links != None:
-            for link in links:
-                params = { "link": link }
-                print(self.manager.add_link_to_experiment(self.expid, params))
+            for part in self._tagged_parts():
+                # Skip links which already exist
+                missing = links
+                if self.graph != None:
+                    missing = self.graph.missing(part.expid, links)
+                for link in missing:
+                    params = { "link": link }
+                    print(self.manager.add_link_to_experiment(part.expid, params))
+
+    def _tagged_parts(self):
+        """ Return the parts of the journal receiving new tags and links
+
+        Tags and links go to this Experiment and, if a rollover policy is
+        set, to the last part of the journal as well, whose tags and links
+        are copied to the following parts.
+        """
+
+        parts = [self]
+        if self._rolls_over() and self._get_tail() is not self:
+            parts.append(self._get_tail())
+        return parts
 
     def __repr__(self):
         self.get()
@@ -274,9 +520,13 @@ class Experiment():
 
         params = { "body": new_body }
         print(self.manager.post_experiment(self.expid, params))
+        self._cells = None
 
     def append_to_body(self, text):
         """ Append text to the Experiment body
+
+        If a rollover policy is set (see set_rollover()), the text is
+        appended to the last part of the journal, creating a new part when needed.
         
         Args:
             text: string of text to be appended to the Experiment body
@@ -284,11 +534,27 @@ class Experiment():
         Return: nothing
         """
 
+        if self._rolls_over():
+            self._journal_part(len(text))._append_to_body(text)
+        else:
+            self._append_to_body(text)
+
+    def _append_to_body(self, text):
+        """ Append text to the body of this Experiment, whatever the rollover policy
+
+        """
+
         params = { "bodyappend": text }
         print(self.manager.post_experiment(self.expid, params))
+        if self._cells != None:
+            self._body_size += len(text)
+            self._entries += 1
 
     def add_meta(self, meta_dict):
         """ Add JSON metadata to the Experiment
+
+        The metadata replaces the existing one, except for the "journal"
+        metadata linking the parts of a journal (see set_rollover()).
         
         Args:
             meta_dict: dictionary of metadata to be added to the Experiment as JSON
@@ -296,7 +562,7 @@ class Experiment():
         Return: nothing
         """
 
-        params = { "metadata": str(meta_dict) }
+        params = { "metadata": json.dumps(self._keep_journal_meta(meta_dict)) }
         print(self.manager.post_experiment(self.expid, params))
 
     def get_meta(self):
@@ -306,7 +572,7 @@ class Experiment():
         """
 
         self.get()
-        return json.loads(self.exp["metadata"])
+        return _parse_meta(self.exp.get("metadata"))
 
     def append_meta(self, meta_dict):
         """ Append JSON metadata to the Experiment
@@ -354,6 +620,13 @@ class Experiment():
         Return: markdown code of the image link
         """
 
+        # Upload and insert the image in the last part of a journal
+        if self._rolls_over():
+            # Size of the image link, before knowing its long_name
+            part = self._journal_part(256)
+            if part is not self:
+                return part.insert_image(image_path, res=res, wh=wh, append=append, html=html)
+
         # Upload image to Experiment
         status = self.upload_file(image_path)
 
@@ -379,8 +652,8 @@ class Experiment():
                         self.append_to_body(html_code)
 
                     return html_code
-                else:
-                    return ""
+            # Image not found among the uploads
+            return ""
         else:
             return ""
 
@@ -395,59 +668,297 @@ class Experiment():
 
         # Get Experiment body
         body = self.get_body()
-        
-        # Split body into cells
-        start = ' data-cell-id='
-        reList = re.split(start, body)
-        
-        # Initialize and populate dictionary of the cells
-        cells = dict()
-        for r in reList:
-            m = re.match(r'\"(\d+)\" data-cell-tags=\"(.+)\" data-cell-datetime=\"(.+)\">', r)
-            groups = m.groups()
-            d = dict()
-            d["tags"] = json.loads(groups[1])
-            d["datetime"] = groups[2]
-            cells[int(groups[0])] = d
-
-        return cells
+
+        return _parse_cells(body)
 
     def _get_max_cell_id(self):
         """ Return the maximum ID of the cells in the Experiment body
 
+        Cell IDs continue across the parts of a journal, see set_rollover().
         """
 
-        cells = self.get_cells_meta()
+        self._load_cells()
+        return self._next_cell_id - 1
+
+    def _load_cells(self):
+        """ Load number of cells, body size and next cell ID from the body
+
+        Only the first call reads the body, then they are updated locally.
+        """
+
+        if self._cells != None:
+            return
+        body = self.get_body() or ""
+        cells = _parse_cells(body)
+        self._cells = len(cells)
+        self._body_size = len(body)
+        # Any content besides the link to the previous part counts as an entry
+        rest = re.sub(r'^<p>Continued from .*?</p>\n', '', body).strip()
+        self._entries = len(cells) if len(cells) != 0 else int(rest != "")
         if len(cells) != 0:
-            return max(cells.keys())
+            self._next_cell_id = max(cells.keys()) + 1
         else:
-            return -1
+            self._next_cell_id = self._get_journal_meta().get("first_cell", 0)
 
     def _add_cell(self, text, tags=list(), title=""):
         """ Add a new cell with the given content to the Experiment body
 
+        If a rollover policy is set (see set_rollover()), the cell is added
+        to the last part of the journal, creating a new part when needed.
+
         Args:
             text: HTML code content of the cell.
             tags: (optional) list of the tags associated to the cell.
             title: (optional) string showed when hovering the mouse on the cell.
 
-        Return: nothing.
+        Return: Experiment (part) to which the cell was added.
         """
 
+        part = self._get_tail() if self._rolls_over() else self
+        part._load_cells()
+
         # Get new cell ID
-        cell_id = self._get_max_cell_id() + 1
+        cell_id = part._next_cell_id
 
         # Generate HTML code for the cell
         timestamp = datetime.now(tzlocal()).replace(microsecond=0).isoformat()
-        HTML_code = '<div title="{}" data-cell-id="{}" data-cell-tags="{}" data-cell-datetime="{}">\n'.format(cell_id, tags, timestamp, title)
+        HTML_code = '<div title="{}" data-cell-id="{}" data-cell-tags="{}" data-cell-datetime="{}">\n'.format(
+            html.escape(title), cell_id, html.escape(json.dumps(tags)), timestamp)
         HTML_code += text
         HTML_code += '\n</div>\n'
 
+        # Start a new part if the cell does not fit in the current one
+        if part._rolls_over() and part._is_full(len(HTML_code)):
+            part = part._rollover()
+            self._tail = part
+
         # Append cell code to Experiment body
-        self.append_to_body(HTML_code)
+        part._append_to_body(HTML_code)
+        part._cells += 1
+        part._next_cell_id = cell_id + 1
+
+        return part
+
+    def set_rollover(self, max_cells=None, max_body_size=None):
+        """ Cap the size of a journal Experiment
+
+        When a cell added with _add_cell(), or text added with
+        append_to_body() or insert_image(), would exceed one of the caps, a
+        continuation Experiment (a new part of the journal) is created with
+        the same title (followed by the part number), date, category, tags
+        and links. Parts point to each other through the "journal" metadata
+        and links in the body, and cell IDs continue across parts, so that
+        adding and reading cells never handles more than one part.
+
+        Args:
+            max_cells: (integer, optional) maximum number of cells (or other appended entries, e.g. images) of each part
+            max_body_size: (integer, optional) maximum body size of each part in characters
+
+        Return: nothing
+        """
+
+        self.max_cells = max_cells
+        self.max_body_size = max_body_size
+
+    def _rolls_over(self):
+        """ Whether a rollover policy is set
+
+        """
+
+        return self.max_cells != None or self.max_body_size != None
+
+    def _journal_part(self, size):
+        """ Return the part of the journal to which size characters can be appended
+
+        """
+
+        part = self._get_tail()
+        part._load_cells()
+        if part._is_full(size):
+            part = part._rollover()
+            self._tail = part
+        return part
+
+    def _is_full(self, size):
+        """ Whether adding an entry of the given size exceeds the rollover caps
+
+        """
+
+        if self._entries == 0:
+            # Never leave a part empty, whatever the size of the entry
+            return False
+        if self.max_cells != None and self._entries >= self.max_cells:
+            return True
+        if self.max_body_size != None and self._body_size + size > self.max_body_size:
+            return True
+        return False
+
+    def _get_tail(self):
+        """ Return the last part of the journal
+
+        """
+
+        if self._tail == None:
+            part = self
+            while part._get_journal_meta().get("next") != None:
+                nxt = Experiment(self.manager, expid=int(part._get_journal_meta()["next"]), graph=self.graph)
+                nxt.set_rollover(self.max_cells, self.max_body_size)
+                part = nxt
+            self._tail = part
+        return self._tail
+
+    def _rollover(self):
+        """ Create the continuation of this journal part
+
+        Return: Experiment of the new part
+        """
+
+        self.get()
+        journal = self._get_journal_meta()
+        number = journal.get("part", 1) + 1
+        title = journal.get("title", self.exp["title"])
+
+        tags = self.exp.get("tags") or list()
+        if isinstance(tags, str):
+            tags = [tag for tag in tags.split("|") if tag]
+        links = [int(link["itemid"]) for link in self.exp.get("links") or list()]
+
+        part = Experiment(self.manager,
+                          title="{} ({})".format(title, number),
+                          date=self.exp.get("date"),
+                          category=self.exp.get("category_id"),
+                          tags=tags,
+                          links=links,
+                          body='<p>Continued from <a href="experiments.php?mode=view&id={0}">{1}</a></p>\n'.format(
+                              self.expid, html.escape(self.exp["title"])),
+                          graph=self.graph)
+        part.set_rollover(self.max_cells, self.max_body_size)
+        part._set_journal_meta(title=title,
+                               part=number,
+                               previous=self.expid,
+                               first_cell=self._next_cell_id)
+        part._load_cells()
+
+        self._set_journal_meta(title=title, part=number - 1, next=part.expid)
+        self._append_to_body('<p>Continued in <a href="experiments.php?mode=view&id={0}">{1}</a></p>\n'.format(
+            part.expid, html.escape(part.exp["title"])))
+
+        return part
+
+    def _get_journal_meta(self):
+        """ Return the "journal" metadata linking the parts of a journal
+
+        """
+
+        return _parse_meta(self.exp.get("metadata")).get("journal", dict())
+
+    def _keep_journal_meta(self, meta_dict):
+        """ Return meta_dict with the current "journal" metadata, if any
+
+        """
+
+        self.get()
+        journal = self._get_journal_meta()
+        if journal and "journal" not in meta_dict:
+            meta_dict = dict(meta_dict, journal=journal)
+        return meta_dict
+
+    def _set_journal_meta(self, **values):
+        """ Update the "journal" metadata, keeping any other metadata
+
+        """
+
+        self.get()
+        metadata = _parse_meta(self.exp.get("metadata"))
+        if not metadata and self.exp.get("metadata"):
+            # Do not lose metadata which cannot be parsed
+            metadata["unparsed"] = self.exp["metadata"]
+        metadata.setdefault("journal", dict()).update(values)
+
+        params = { "metadata": json.dumps(metadata) }
+        print(self.manager.post_experiment(self.expid, params))
+        self.get()
 
     def _get_cell(self, cell_id):
         pass
 
     def _replace_cell(self, cell_id, text):
         pass
+
+def _parse_cells(body):
+    """ Parse the metadata of the cells within an Experiment body
+
+    Return: dictionary of cell metadata, see Experiment._get_cells_meta.
+    """
+
+    # Split body into cells
+    start = ' data-cell-id='
+    reList = re.split(start, body)
+
+    # Initialize and populate dictionary of the cells
+    cells = dict()
+    for r in reList:
+        m = re.match(r'\"(\d+)\" data-cell-tags=\"(.+)\" data-cell-datetime=\"(.+)\">', r)
+        # Skip text preceding the first cell
+        if m is None:
+            continue
+        groups = m.groups()
+        d = dict()
+        d["tags"] = json.loads(html.unescape(groups[1]))
+        d["datetime"] = groups[2]
+        cells[int(groups[0])] = d
+
+    return cells
+
+def _parse_meta(metadata):
+    """ Parse Experiment metadata into a dictionary
+
+    Metadata written by older versions of add_meta is a Python dictionary
+    representation rather than JSON. Metadata which cannot be parsed gives
+    an empty dictionary.
+    """
+
+    if isinstance(metadata, dict):
+        return metadata
+    if not metadata:
+        return dict()
+    try:
+        metadata = json.loads(metadata)
+    except ValueError:
+        try:
+            metadata = ast.literal_eval(metadata)
+        except (ValueError, SyntaxError):
+            return dict()
+    if not isinstance(metadata, dict):
+        return dict()
+    return metadata
+
+def _export_row(exp, meta_keys):
+    """ Flatten an experiment into a row of Manager.export
+
+    """
+
+    metadata = _parse_meta(exp.get('metadata')) or None
+
+    tags = exp.get('tags') or list()
+    if isinstance(tags, str):
+        tags = [tag for tag in tags.split("|") if tag]
+
+    row = {
+        "id": int(exp['id']),
+        "title": exp.get('title'),
+        "date": exp.get('date'),
+        "category": exp.get('category'),
+        "tags": tags,
+        "links": [int(link['itemid']) for link in exp.get('links') or list()],
+        "metadata": metadata,
+        "cells": {str(k): v for k, v in _parse_cells(exp.get('body') or "").items()},
+        }
+
+    for key in meta_keys:
+        value = metadata
+        for part in key.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        row["meta." + key] = value
+
+    return row
@@ -0,0 +1,128 @@
+import csv
+import json
+import os
+
+# Columns always present in an export, in order
+COLUMNS = ["id", "title", "date", "category", "tags", "links", "metadata", "cells"]
+
+FORMATS = {
+    ".csv": "csv",
+    ".parquet": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+    }
+
+def get_writer(path, columns, format=None):
+    """ Open a chunked writer for an export
+
+    Args:
+        path: path of the output file
+        columns: list of the column names
+        format: (string, optional) "csv", "parquet" or "arrow". If not given it is guessed from the file extension.
+
+    Return: writer with write(rows) and close() methods
+    """
+
+    if format is None:
+        ext = os.path.splitext(path)[1].lower()
+        if ext not in FORMATS:
+            raise ValueError("Cannot guess export format of {}, use one of {}.".format(path, sorted(FORMATS)))
+        format = FORMATS[ext]
+
+    if format == "csv":
+        return CSVWriter(path, columns)
+    elif format in ("parquet", "arrow"):
+        return ArrowWriter(path, columns, format)
+    else:
+        raise ValueError("Unknown export format {}.".format(format))
+
+class CSVWriter():
+
+    def __init__(self, path, columns):
+        """Write rows to a CSV file, list and dictionary values as JSON
+
+        Args:
+            path: path of the output file
+            columns: list of the column names
+
+        Return: None
+        """
+
+        self.file = open(path, "w", newline="")
+        self.writer = csv.DictWriter(self.file, fieldnames=columns)
+        self.writer.writeheader()
+
+    def write(self, rows):
+        for row in rows:
+            self.writer.writerow({k: _cell(v) for k, v in row.items()})
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class ArrowWriter():
+
+    def __init__(self, path, columns, format="parquet"):
+        """Write rows to a Parquet or Arrow IPC file, one record batch per chunk
+
+        Requires pyarrow. "tags" and "links" are stored as lists, every
+        other non-scalar value as a JSON string.
+
+        Args:
+            path: path of the output file
+            columns: list of the column names
+            format: (string, optional) "parquet" (default) or "arrow"
+
+        Return: None
+        """
+
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError("pyarrow is required to export to {}, install it with: pip install pyarrow".format(format))
+
+        self.pa = pa
+        fields = list()
+        for c in columns:
+            if c == "id":
+                fields.append(pa.field(c, pa.int64()))
+            elif c == "tags":
+                fields.append(pa.field(c, pa.list_(pa.string())))
+            elif c == "links":
+                fields.append(pa.field(c, pa.list_(pa.int64())))
+            else:
+                fields.append(pa.field(c, pa.string()))
+        self.schema = pa.schema(fields)
+
+        if format == "parquet":
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(path, self.schema)
+        else:
+            import pyarrow.ipc as ipc
+            self.sink = pa.OSFile(path, "wb")
+            self.writer = ipc.new_file(self.sink, self.schema)
+
+    def write(self, rows):
+        if not rows:
+            return
+        columns = dict()
+        for field in self.schema:
+            values = [row.get(field.name) for row in rows]
+            if field.name not in ("id", "tags", "links"):
+                values = [v if v is None or isinstance(v, str) else json.dumps(v, sort_keys=True) for v in values]
+            columns[field.name] = values
+        self.writer.write_table(self.pa.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+        if hasattr(self, "sink"):
+            self.sink.close()
+
+def _cell(value):
+    """ Convert a value to a scalar to be stored in a single cell
+
+    """
+
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, sort_keys=True)
+    return value
@@ -0,0 +1,222 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class LinkGraph():
+
+    def __init__(self, instance, index, max_age=300.0, workers=8):
+        """Local cache of the links between experiments and items
+
+        The graph keeps both the experiment->items and the item->experiments
+        adjacency. It reuses the full listings of the search index (no second
+        listing is made) and takes the links from them when the server lists
+        them. Experiments listed without their links are fetched, in
+        parallel as bulk traffic, only when the graph is queried by item
+        (load()). Links older than "max_age" seconds are fetched again, to
+        pick up links made by other users, and every link written through
+        the Client is recorded, so that links can be queried and diffed
+        without per-experiment GETs.
+
+        Args:
+            instance: metalog.client.Client used to fetch the experiments
+            index: search.SearchIndex whose full listings populate the graph
+            max_age: (float, optional) seconds after which links are fetched again
+            workers: (integer, optional) parallel fetches of experiments listed without their links
+
+        Return: None
+        """
+
+        self.manager = instance
+        self.index = index
+        self.max_age = max_age
+        self.workers = workers
+
+        self._lock = threading.RLock()
+        self._items = dict()
+        self._experiments = dict()
+        # Time at which the links of each experiment were read
+        self._fetched = dict()
+        self._loaded = None
+
+        # Experiments of the last complete listing and of the current one
+        self._listed = set()
+        self._seen = set()
+
+        self.index.listing_listeners.append(self.on_listing)
+
+    def __repr__(self):
+        return "Link graph of {} experiments.".format(len(self._items))
+
+    def notify(self, name, args, result):
+        """ Listener of the Client writes, records new links and experiments
+
+        """
+
+        if name == "add_link_to_experiment":
+            try:
+                expid, itemid = int(args[0]), int(args[1]["link"])
+            except (IndexError, KeyError, TypeError, ValueError):
+                return
+            with self._lock:
+                # Links of unknown experiments are fetched when needed
+                if expid in self._items:
+                    self._add(expid, itemid)
+        elif name == "create_experiment":
+            try:
+                expid = int(result["id"])
+            except (KeyError, TypeError, ValueError):
+                return
+            with self._lock:
+                if expid not in self._items:
+                    self._set(expid, None, time.monotonic())
+                self._listed.add(expid)
+
+    def on_listing(self, page, offset):
+        """ Listener of the full listings of the search index
+
+        Only records the listed experiments and the links included in the
+        listing, never sends requests.
+
+        Args:
+            page: list of experiments, or None once the listing is complete
+            offset: offset of the page in the listing
+
+        Return: nothing
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            if page is None:
+                # Drop deleted experiments
+                for expid in set(self._items) - self._seen:
+                    self._set(expid, None, None)
+                    del self._items[expid]
+                    del self._fetched[expid]
+                self._listed, self._seen = self._seen, set()
+                return
+            if offset == 0:
+                self._seen = set()
+            for exp in page:
+                expid = int(exp['id'])
+                self._seen.add(expid)
+                if 'links' in exp:
+                    self._set(expid, exp['links'], now)
+
+    def load(self, reload=False):
+        """ Bring the links of all the experiments up to date, if older than max_age
+
+        The experiments are listed by the search index, then those listed
+        without up to date links are fetched in parallel.
+
+        Args:
+            reload: (boolean, optional) load again even if up to date
+
+        Return: nothing
+        """
+
+        with self._lock:
+            if not reload and self._loaded is not None and time.monotonic() - self._loaded <= self.max_age:
+                return
+
+        start = time.monotonic()
+        self.index.sync(full=True)
+
+        with self._lock:
+            stale = [expid for expid in self._listed
+                     if self._fetched.get(expid) is None or self._fetched[expid] < start]
+
+        # Older elabFTW versions do not list links, fetch those experiments
+        if stale:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for expid, exp in zip(stale, executor.map(self._fetch, stale)):
+                    with self._lock:
+                        self._set(expid, exp.get('links'), start)
+
+        with self._lock:
+            self._loaded = start
+
+    def get_links(self, expid):
+        """ Get the items linked to an experiment
+
+        Args:
+            expid: (integer) id of the experiment
+
+        Return:
+            Set of item ids
+        """
+
+        expid = int(expid)
+        with self._lock:
+            fetched = self._fetched.get(expid)
+            if fetched is not None and time.monotonic() - fetched <= self.max_age:
+                return set(self._items[expid])
+        return self._refresh(expid)
+
+    def get_experiments(self, itemid):
+        """ Get the experiments linked to an item
+
+        Args:
+            itemid: (integer) id of the item
+
+        Return:
+            Set of experiment ids
+        """
+
+        self.load()
+        with self._lock:
+            return set(self._experiments.get(int(itemid), set()))
+
+    def missing(self, expid, links):
+        """ Get the links not yet existing for an experiment
+
+        The links of the experiment are read again first (a single GET,
+        usually answered by the Client cache), so that links removed by
+        other users are not skipped.
+
+        Args:
+            expid: (integer) id of the experiment
+            links: list of item ids to be linked
+
+        Return:
+            List of the item ids in links not linked to the experiment, in the given order and without duplicates
+        """
+
+        existing = self._refresh(int(expid))
+        missing = list()
+        for link in links:
+            if int(link) not in existing:
+                existing.add(int(link))
+                missing.append(link)
+        return missing
+
+    def _refresh(self, expid):
+        """ Fetch the links of an experiment, return them as a set
+
+        """
+
+        now = time.monotonic()
+        exp = self.manager.get_experiment(expid)
+        with self._lock:
+            self._set(expid, exp.get('links'), now)
+            return set(self._items[expid])
+
+    def _fetch(self, expid):
+        # Fetched once per load, do not fill the Client cache with them
+        with self.manager.controller.bulk(), self.manager.uncached():
+            return self.manager.get_experiment(expid)
+
+    def _set(self, expid, links, fetched):
+        # Must be called with self._lock held
+        for itemid in self._items.pop(expid, set()):
+            self._experiments[itemid].discard(expid)
+            if not self._experiments[itemid]:
+                del self._experiments[itemid]
+        self._items[expid] = set()
+        self._fetched[expid] = fetched
+        for link in links or list():
+            self._add(expid, int(link['itemid']))
+
+    def _add(self, expid, itemid):
+        # Must be called with self._lock held
+        self._items.setdefault(expid, set()).add(itemid)
+        self._experiments.setdefault(itemid, set()).add(expid)
@@ -1,8 +1,8 @@
 import streamlit as st
 from tools import instrument_changed, system_changed, add_procedure, get_database
 from tools import journal_log, sample_log, instrument_log
+from tools import search_experiments, set_date
 import elab
-import datetime
 
 def connect2elab():
     endpoint = st.session_state["endpoint"]
@@ -26,14 +26,7 @@ def main():
         st.session_state.preparation_steps = list()
 
     # Set current date
-    now = datetime.datetime.now()
-    year = now.strftime("%y")
-    st.session_state.year = "20"+year
-    month = now.strftime("%m")
-    st.session_state.month = month
-    day = now.strftime("%d")
-    st.session_state.day = day
-    st.session_state.date = year + month + day
+    set_date(st.session_state)
 
     database = st.session_state["database"]
     systems_names = ("",) + tuple(database["System"].keys())
@@ -50,6 +43,13 @@ def main():
     with st.sidebar:
         st.write("# MetaLog")
 
+        search_query = st.text_input(
+            "Search experiments",
+            key="search_query",
+            help="Words in title, body or tags of the experiments.")
+        for exp in search_experiments(st.session_state):
+            st.write("{0} {1} (#{2})".format(exp["date"], exp["title"], exp["id"]))
+
     ### Top entries
     system_column, researchers_column = st.columns([1, 3])
     project_column, topic_column = st.columns(2)
@@ -0,0 +1,282 @@
+import bisect
+import re
+import threading
+import time
+
+import requests
+
+class SearchIndex():
+
+    def __init__(self, instance, page_size=100, max_age=300.0):
+        """Local search index over the elabFTW experiments
+
+        The index keeps an inverted index of the words in titles, bodies and
+        tags, a tag index, a category index and a date index. It is built
+        with a paged listing of all the experiments, then kept in sync
+        incrementally: writes made through the Client mark the touched
+        experiments as dirty and only those are fetched again before the
+        next query. A full listing is repeated every "max_age" seconds to
+        pick up changes made by other users. Other structures built from
+        the same listing (e.g. links.LinkGraph) can register in
+        "listing_listeners" instead of listing again.
+
+        Args:
+            instance: metalog.client.Client used to fetch the experiments
+            page_size: (integer, optional) number of experiments fetched per listing request
+            max_age: (float, optional) seconds after which the index is rebuilt from a full listing
+
+        Return: None
+        """
+
+        self.manager = instance
+        self.page_size = page_size
+        self.max_age = max_age
+
+        self._lock = threading.RLock()
+        self._docs = dict()
+        self._words = dict()
+        self._tags = dict()
+        self._categories = dict()
+        self._dates = list()
+        self._vocabulary = None
+        self._dirty = set()
+        self._synced = None
+
+        # Callables notified as listener(page, offset) for each page of a full
+        # listing, then as listener(None, offset) once the listing is complete
+        self.listing_listeners = list()
+
+    def __repr__(self):
+        return "Search index of {} experiments.".format(len(self._docs))
+
+    def __len__(self):
+        return len(self._docs)
+
+    def notify(self, name, args, result):
+        """ Listener of the Client writes, marks touched experiments as dirty
+
+        """
+
+        if "experiment" not in name:
+            return
+        if name == "create_experiment":
+            try:
+                expid = int(result["id"])
+            except (KeyError, TypeError, ValueError):
+                return
+        elif args:
+            expid = int(args[0])
+        else:
+            return
+        with self._lock:
+            self._dirty.add(expid)
+
+    def sync(self, full=False):
+        """ Bring the index up to date
+
+        Args:
+            full: (boolean, optional) force a full listing of the experiments
+
+        Return: nothing
+        """
+
+        with self._lock:
+            if full or self._synced is None or time.monotonic() - self._synced > self.max_age:
+                self._sync_all()
+            else:
+                dirty, self._dirty = list(self._dirty), set()
+                for i, expid in enumerate(dirty):
+                    try:
+                        self._update(self.manager.get_experiment(expid))
+                    except requests.HTTPError as e:
+                        if getattr(e.response, "status_code", None) != 404:
+                            # Keep the failed and the unprocessed experiments dirty
+                            self._dirty.update(dirty[i:])
+                            raise
+                        if expid in self._docs:
+                            self._remove(expid)
+                    except Exception:
+                        self._dirty.update(dirty[i:])
+                        raise
+
+    def _sync_all(self):
+        # Must be called with self._lock held
+        dirty, self._dirty = self._dirty, set()
+        start = time.monotonic()
+
+        seen = set()
+        offset = 0
+        try:
+            while True:
+                page = self.manager.get_all_experiments(params={'limit': self.page_size, 'offset': offset})
+                for exp in page:
+                    seen.add(int(exp['id']))
+                    self._update(exp)
+                for listener in self.listing_listeners:
+                    listener(page, offset)
+                if len(page) < self.page_size:
+                    break
+                offset += self.page_size
+        except Exception:
+            # Keep the index stale, so that the next query lists again
+            self._dirty |= dirty
+            raise
+
+        for expid in set(self._docs) - seen:
+            self._remove(expid)
+        for listener in self.listing_listeners:
+            listener(None, offset)
+
+        # Mark fresh only once the whole listing succeeded
+        self._synced = start
+
+    def search(self,
+               text=None,
+               tags=None,
+               category=None,
+               date_from=None,
+               date_to=None):
+        """ Search the indexed experiments
+
+        Args:
+            text: (string, optional) words to be found in title, body or tags. Every word is matched as a prefix.
+            tags: (list, optional) list of tags the experiment must have
+            category: (string, optional) category of the experiment
+            date_from: (string, optional) earliest date of the experiment (e.g. "20210315" or "2021-03-15")
+            date_to: (string, optional) latest date of the experiment (e.g. "20210315" or "2021-03-15")
+
+        Return:
+            List of dictionaries ("id", "title", "date", "category", "tags") sorted by date, newest first
+        """
+
+        with self._lock:
+            sets = list()
+            if text:
+                for word in _words(text):
+                    sets.append(self._prefix(word))
+            if tags:
+                for tag in tags:
+                    sets.append(self._tags.get(tag, set()))
+            if category is not None:
+                sets.append(self._categories.get(category, set()))
+            if date_from is not None or date_to is not None:
+                lo = bisect.bisect_left(self._dates, (_date(date_from),)) if date_from is not None else 0
+                hi = bisect.bisect_right(self._dates, (_date(date_to), float("inf"))) if date_to is not None else len(self._dates)
+                sets.append({expid for _, expid in self._dates[lo:hi]})
+
+            if sets:
+                sets.sort(key=len)
+                found = set(sets[0]).intersection(*sets[1:])
+            else:
+                found = set(self._docs)
+
+            results = [dict(self._docs[expid]["summary"]) for expid in found]
+
+        results.sort(key=lambda r: (r["date"], r["id"]), reverse=True)
+        return results
+
+    def _prefix(self, word):
+        # Must be called with self._lock held
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._words)
+        found = set()
+        i = bisect.bisect_left(self._vocabulary, word)
+        while i < len(self._vocabulary) and self._vocabulary[i].startswith(word):
+            found |= self._words[self._vocabulary[i]]
+            i += 1
+        return found
+
+    def _update(self, exp):
+        # Must be called with self._lock held
+        expid = int(exp['id'])
+        tags = _tags(exp.get('tags'))
+        summary = {
+            "id": expid,
+            "title": exp.get('title') or "",
+            "date": _date(exp.get('date')),
+            "category": exp.get('category'),
+            "tags": tags,
+            }
+        fingerprint = hash((summary["title"], summary["date"], summary["category"],
+                            tuple(tags), exp.get('body') or ""))
+
+        doc = self._docs.get(expid)
+        if doc is not None:
+            if doc["fingerprint"] == fingerprint:
+                return
+            self._remove(expid)
+
+        words = set(_words(summary["title"]))
+        words.update(_words(_strip_html(exp.get('body') or "")))
+        for tag in tags:
+            words.update(_words(tag))
+
+        self._docs[expid] = {"summary": summary, "fingerprint": fingerprint, "words": words}
+        for word in words:
+            if word not in self._words:
+                self._vocabulary = None
+            self._words.setdefault(word, set()).add(expid)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(expid)
+        self._categories.setdefault(summary["category"], set()).add(expid)
+        bisect.insort(self._dates, (summary["date"], expid))
+
+    def _remove(self, expid):
+        # Must be called with self._lock held
+        doc = self._docs.pop(expid)
+        summary = doc["summary"]
+        for word in doc["words"]:
+            _discard(self._words, word, expid)
+            if word not in self._words:
+                self._vocabulary = None
+        for tag in summary["tags"]:
+            _discard(self._tags, tag, expid)
+        _discard(self._categories, summary["category"], expid)
+        i = bisect.bisect_left(self._dates, (summary["date"], expid))
+        del self._dates[i]
+
+def _discard(index, key, expid):
+    """ Remove expid from index[key], dropping empty keys
+
+    """
+
+    ids = index.get(key)
+    if ids is not None:
+        ids.discard(expid)
+        if not ids:
+            del index[key]
+
+def _words(text):
+    """ Split text into lowercase words
+
+    """
+
+    return re.findall(r"\w+", text.lower())
+
+def _strip_html(text):
+    """ Remove HTML tags from text
+
+    """
+
+    return re.sub(r"<[^>]*>", " ", text)
+
+def _tags(tags):
+    """ Return the tags of an experiment as a list
+
+    elabFTW returns the tags as a single string separated by "|".
+    """
+
+    if not tags:
+        return list()
+    if isinstance(tags, str):
+        return [tag for tag in tags.split("|") if tag]
+    return list(tags)
+
+def _date(date):
+    """ Normalize a date to the "YYYYMMDD" format
+
+    """
+
+    if date is None:
+        return ""
+    return str(date).replace("-", "")[:8]
@@ -0,0 +1,214 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+# HTTP statuses which signal an overloaded server
+OVERLOAD_STATUSES = (429, 500, 502, 503, 504)
+# HTTP statuses for which a rejected write was surely not applied
+RETRY_WRITE_STATUSES = (429, 503)
+# Latency increase in seconds always tolerated, whatever the fastest latency
+LATENCY_SLACK = 0.1
+
+class Controller():
+
+    def __init__(self,
+                 initial=4,
+                 min_limit=2,
+                 max_limit=16,
+                 max_total=16,
+                 reserve=1,
+                 tolerance=2.0,
+                 max_retries=5,
+                 backoff=0.5,
+                 max_backoff=30.0):
+        """Adaptive (AIMD) concurrency controller for elabFTW requests
+
+        Each endpoint (e.g. "experiments", "items") has its own concurrency
+        limit. The limit grows by one every round trip while latency stays
+        within "tolerance" times the fastest latency observed for the same
+        operation (e.g. a listing is not compared to a single GET), and is
+        halved when the server answers 429/5xx or latency degrades.
+        Overloaded requests are retried after a jittered exponential backoff.
+
+        Calls issued within "bulk()" may use at most "limit - reserve"
+        slots of each endpoint and "max_total - reserve" slots overall, and
+        wait when none is left, so interactive calls always find a free slot.
+
+        Args:
+            initial: (integer, optional) initial concurrency limit of each endpoint
+            min_limit: (integer, optional) minimum concurrency limit of each endpoint, at least reserve + 1 so that bulk calls are never starved
+            max_limit: (integer, optional) maximum concurrency limit of each endpoint
+            max_total: (integer, optional) maximum number of concurrent requests across all endpoints
+            reserve: (integer, optional) slots of each endpoint reserved to interactive calls
+            tolerance: (float, optional) latency increase, relative to the fastest observed, tolerated before backing off
+            max_retries: (integer, optional) number of retries of overloaded requests
+            backoff: (float, optional) base delay of the retries in seconds
+            max_backoff: (float, optional) maximum delay of the retries in seconds
+
+        Return: None
+        """
+
+        self.min_limit = max(min_limit, reserve + 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.max_total = max(max_total, self.min_limit)
+        self.initial = min(max(initial, self.min_limit), self.max_limit)
+        self.reserve = reserve
+        self.tolerance = tolerance
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._cond = threading.Condition()
+        self._endpoints = dict()
+        self._total = 0
+        self._local = threading.local()
+
+    def __repr__(self):
+        with self._cond:
+            limits = {k: round(v.limit, 2) for k, v in self._endpoints.items()}
+        return "Controller with limits {}.".format(limits)
+
+    def get_limits(self):
+        """ Get the current concurrency limit of each endpoint
+
+        Return:
+            Dictionary mapping endpoint names to their concurrency limit
+        """
+
+        with self._cond:
+            return {k: int(v.limit) for k, v in self._endpoints.items()}
+
+    @contextmanager
+    def bulk(self):
+        """ Context manager marking the calls of the current thread as bulk traffic
+
+        """
+
+        previous = getattr(self._local, "bulk", False)
+        self._local.bulk = True
+        try:
+            yield self
+        finally:
+            self._local.bulk = previous
+
+    def call(self, endpoint, func, *args, operation=None, write=False, rewind=None, attempted=None, **kwargs):
+        """ Call func within the concurrency limit of the given endpoint
+
+        Args:
+            endpoint: (string) name of the endpoint (e.g. "experiments")
+            func: callable performing the request
+            operation: (string, optional) name of the operation (e.g. "get_experiment"), whose latencies are compared with each other. Defaults to the endpoint.
+            write: (boolean, optional) whether the request modifies data. Writes are retried only if surely not applied.
+            rewind: (callable, optional) called before each retry to restore the arguments (e.g. rewind files). If False the request is never retried.
+            attempted: (callable, optional) called each time the request is sent, retries included
+
+        Return: result of func
+        """
+
+        attempt = 0
+        while True:
+            self._acquire(endpoint)
+            start = time.monotonic()
+            status = None
+            if attempted:
+                attempted()
+            try:
+                return func(*args, **kwargs)
+            except requests.HTTPError as e:
+                status = getattr(e.response, "status_code", None)
+                retry = status in (RETRY_WRITE_STATUSES if write else OVERLOAD_STATUSES)
+                delay = _retry_after(e.response)
+                if not retry or rewind is False or attempt >= self.max_retries:
+                    raise
+            except (requests.ConnectionError, requests.Timeout):
+                status = 503
+                delay = None
+                if write or rewind is False or attempt >= self.max_retries:
+                    raise
+            finally:
+                self._release(endpoint, operation or endpoint, time.monotonic() - start, status)
+
+            if delay is None:
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            time.sleep(delay)
+            if rewind:
+                rewind()
+            attempt += 1
+
+    def _endpoint(self, endpoint):
+        # Must be called with self._cond held
+        state = self._endpoints.get(endpoint)
+        if state is None:
+            state = _Endpoint(self.initial)
+            self._endpoints[endpoint] = state
+        return state
+
+    def _acquire(self, endpoint):
+        bulk = getattr(self._local, "bulk", False)
+        with self._cond:
+            state = self._endpoint(endpoint)
+            while True:
+                allowed = int(state.limit)
+                total = self.max_total
+                if bulk:
+                    # Leave room to interactive calls, even if it means waiting
+                    allowed -= self.reserve
+                    total -= self.reserve
+                if state.inflight < allowed and self._total < total:
+                    break
+                self._cond.wait()
+            state.inflight += 1
+            self._total += 1
+
+    def _release(self, endpoint, operation, latency, status):
+        with self._cond:
+            state = self._endpoint(endpoint)
+            state.inflight -= 1
+            self._total -= 1
+
+            now = time.monotonic()
+            if status in OVERLOAD_STATUSES:
+                slow = True
+            elif status is None:
+                # Let the reference latency drift up, so that a single lucky
+                # round trip does not throttle the endpoint forever
+                fastest = min(latency, state.fastest.get(operation, latency) * 1.01)
+                state.fastest[operation] = fastest
+                slow = latency > max(self.tolerance * fastest, fastest + LATENCY_SLACK)
+            else:
+                # Client errors (e.g. 404) say nothing about the load
+                slow = None
+
+            if slow:
+                # Back off at most once per round trip
+                if now - state.last_decrease > latency:
+                    factor = 0.5 if status is not None else 0.9
+                    state.limit = max(self.min_limit, state.limit * factor)
+                    state.last_decrease = now
+            elif slow is not None:
+                state.limit = min(self.max_limit, state.limit + 1 / state.limit)
+
+            self._cond.notify_all()
+
+class _Endpoint():
+    """ Concurrency state of a single endpoint """
+
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.inflight = 0
+        # Fastest latency observed for each operation
+        self.fastest = dict()
+        self.last_decrease = 0.0
+
+def _retry_after(response):
+    """ Return the delay requested by a Retry-After header, if any
+
+    """
+
+    try:
+        return min(float(response.headers["Retry-After"]), 300.0)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
@@ -1,12 +1,43 @@
-import streamlit as st
 import sys
-import elab
+import datetime
+
+# Caps of each journal experiment, continuation experiments are created beyond them
+JOURNAL_MAX_CELLS = 100
+JOURNAL_MAX_BODY_SIZE = 200000
+
+class LogError(Exception):
+    """ Log entry rejected by the validation, raised when running headless """
+    pass
+
+def warning(text):
+    """ Show a warning in the Streamlit app, or raise LogError when running headless
+
+    Callers must leave the state consistent before calling it.
+    """
+
+    # Streamlit is loaded only by the app, never import it from here
+    st = sys.modules.get("streamlit")
+    if st is not None:
+        st.warning(text)
+    else:
+        raise LogError(text)
+
+def success(text):
+    """ Show a success message in the Streamlit app, or print it when running headless
+
+    """
+
+    st = sys.modules.get("streamlit")
+    if st is not None:
+        st.success(text)
+    else:
+        print(text, file=sys.stderr)
 
 def journal_log(state):
 
     if not state.System:
-        st.warning("Select at least a System before creating a journal entry.")
         state.journal_exp = None
+        warning("Select at least a System before creating a journal entry.")
     else:
         title = state.year+"-"+state.month+"-"+state.day
         journal_exp = state.manager.create_experiment()
@@ -19,22 +50,23 @@ def journal_log(state):
         status_id = get_status_id(state)
         if status_id:
             journal_exp.update(category=status_id)
-        st.success("Journal entry {0} created.".format(title))
+        journal_exp.set_rollover(max_cells=JOURNAL_MAX_CELLS, max_body_size=JOURNAL_MAX_BODY_SIZE)
+        success("Journal entry {0} created.".format(title))
         state.journal_exp = journal_exp
 
 def sample_log(state):
 
-    if "journal_exp" not in state:
-        st.warning("Create a journal entry before logging a Sample Preparation.")
+    if not state.get("journal_exp"):
         state.sample_exp = None
+        warning("Create a journal entry before logging a Sample Preparation.")
         return
     elif not state.prev_prep and not all([state.sample_name, state.sample_preparation_id, state.sample_preparation]):
-        st.warning("Provide at least Name, Preparation ID and Description.")
         state.sample_exp = None
+        warning("Provide at least Name, Preparation ID and Description.")
         return
     elif state.prev_prep and not state.sample_name:
-        st.warning("Provide at least Sample Preparation Name.")
         state.sample_exp = None
+        warning("Provide at least Sample Preparation Name.")
         return
     else:
         title = state.sample_name+state.sample_preparation_id
@@ -56,11 +88,37 @@ def sample_log(state):
             #links=[state.sample_exp.expid],
             tags=[title]
             )
-        st.success("Sample entry {0} logged.".format(title))
+        success("Sample entry {0} logged.".format(title))
 
 def instrument_log(state):
     pass
 
+def upload_log(state):
+
+    if state.upload_expid:
+        exp = state.manager.get_experiment(int(state.upload_expid))
+    elif state.get("journal_exp"):
+        exp = state.journal_exp
+    else:
+        warning("Create a journal entry or give an experiment ID before uploading files.")
+        return
+
+    for path in state.upload_files or list():
+        exp.upload_file(path)
+    for path in state.upload_images or list():
+        exp.insert_image(path, html=True)
+    success("Files uploaded to experiment {0}.".format(exp.expid))
+
+def set_date(state):
+    now = datetime.datetime.now()
+    year = now.strftime("%y")
+    state.year = "20"+year
+    month = now.strftime("%m")
+    state.month = month
+    day = now.strftime("%d")
+    state.day = day
+    state.date = year + month + day
+
 def get_links(state, categories):
     links = list()
     for cat in categories:
@@ -84,6 +142,12 @@ def get_status_id(state, is_sample=False):
             status_id = status["category_id"]
     return status_id
 
+def search_experiments(state):
+    query = state.search_query
+    if not query:
+        return list()
+    return state.manager.search(text=query)
+
 def instrument_changed(state):
     pass
 
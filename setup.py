@@ -21,6 +21,15 @@ setup(
         "streamlit",
         "python-dateutil",
     ],
+    extras_require={
+        "yaml": ["pyyaml"],
+        "export": ["pyarrow"],
+    },
+    entry_points={
+        "console_scripts": [
+            "metalog = metalog.cli:main",
+        ],
+    },
     classifiers=[
         "Development Status :: 4 - Beta",
         "Intended Audience :: Science/Research",